@@ -1,18 +1,27 @@
 from pathlib import Path
 import re
+from typing import Optional
 
 import click
 import click_pathlib
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from waitress import serve
 
 from xrays.analysis import acquire_base_data
-from xrays.dashboard import create_app
+from xrays.dashboard import create_app, data_columns
 
 
 def hotspot_data_file(out_path: Path) -> Path:
     return out_path / "hotspots.parquet"
 
 
+def hotspot_table_file(out_path: Path) -> Path:
+    """Uncompressed copy of the data that can be memory-mapped."""
+    return out_path / "hotspots.arrow"
+
+
 @click.group()
 def hotspots() -> None:
     pass
@@ -24,20 +33,72 @@ def hotspots() -> None:
     default=".*",
     help="Only include files in the repository matching this regular expression",
 )
+@click.option(
+    "--follow-renames/--no-follow-renames",
+    default=True,
+    help="Attribute commits made before a rename to the current file name",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of parallel processes, defaults to the number of CPUs",
+)
 @click.argument("git_root", type=click_pathlib.Path())
 @click.argument("data_dir", type=click_pathlib.Path())
-def compute(git_root: Path, file_pattern: str, data_dir: Path) -> None:
+def compute(
+    git_root: Path,
+    file_pattern: str,
+    follow_renames: bool,
+    jobs: Optional[int],
+    data_dir: Path,
+) -> None:
     data_dir.mkdir(exist_ok=True)
 
-    data = acquire_base_data(git_root, re.compile(file_pattern))
-    data.to_parquet(hotspot_data_file(data_dir))
+    data = acquire_base_data(
+        git_root, re.compile(file_pattern), follow_renames=follow_renames, jobs=jobs
+    )
+    pq.write_table(
+        data,
+        hotspot_data_file(data_dir),
+        compression="zstd",
+        use_dictionary=["file", "commit"],
+        row_group_size=50_000,
+    )
+    with pa.ipc.new_file(str(hotspot_table_file(data_dir)), data.schema) as writer:
+        writer.write_table(data)
 
 
 @hotspots.command()
+@click.option(
+    "--debug/--no-debug",
+    default=False,
+    envvar="XRAYS_DEBUG",
+    help="Use the Flask development server with debugging and reloading",
+)
+@click.option("--host", default="127.0.0.1", help="Interface to listen on")
+@click.option("--port", type=int, default=8050, help="Port to listen on")
+@click.option(
+    "--threads", type=int, default=8, help="Number of threads serving requests"
+)
 @click.argument("data_dir", type=click_pathlib.Path(exists=True))
-def visualize(data_dir: Path) -> None:
-    data = pd.read_parquet(hotspot_data_file(data_dir))
-    create_app(data).run_server(debug=True)
+def visualize(data_dir: Path, debug: bool, host: str, port: int, threads: int) -> None:
+    table_file = hotspot_table_file(data_dir)
+    if table_file.exists():
+        # stays mapped for the lifetime of the server, restarts can reuse the
+        # page cache instead of decompressing the parquet file again
+        table = pa.ipc.open_file(pa.memory_map(str(table_file))).read_all()
+        data = table.select(data_columns).to_pandas(split_blocks=True)
+    else:
+        data = pd.read_parquet(
+            hotspot_data_file(data_dir), engine="pyarrow", columns=data_columns
+        )
+    app = create_app(data)
+    if debug:
+        app.run_server(debug=True, host=host, port=port)
+    else:
+        serve(app.server, host=host, port=port, threads=threads)
 
 
 if __name__ == "__main__":
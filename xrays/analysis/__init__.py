@@ -1,116 +1,461 @@
-import itertools
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import functools
 import json
-from pathlib import Path
+import os
+from pathlib import Path, PurePath
+import re
 import subprocess
 from tempfile import TemporaryDirectory
-from typing import List, Pattern, Tuple
+from typing import IO, Dict, Iterator, List, Optional, Pattern, Tuple
 
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+from pygments.lexer import Lexer
+from pygments.lexers import get_all_lexers, get_lexer_for_filename
+from pygments.lexers.special import TextLexer
+from pygments.token import _TokenType, Comment, String
+from pygments.util import ClassNotFound
 from tqdm import tqdm
 
+# commit, author and commit date in seconds since the epoch
+Revision = Tuple[str, int, int]
+# indentation, code lines, comment lines
+Metrics = Tuple[int, int, int]
+
+
+# file patterns of the form .*\.ext that can be expressed as a git pathspec
+EXTENSION_PATTERN = re.compile(r"\.\*\\\.(\w+)\$?")
+
 
 def relevant_files_in_git_root(git_root: Path, pattern: Pattern) -> List[Path]:
+    extension = EXTENSION_PATTERN.fullmatch(pattern.pattern)
+    if extension and not pattern.flags & re.IGNORECASE:
+        # let git filter by extension instead of matching every file here
+        return [Path(f) for f in git_files(git_root, f"*.{extension.group(1)}")]
+
+    files = git_files(git_root)
+    if pattern.pattern == ".*":
+        # the default pattern matches everything
+        return [Path(f) for f in files]
+
+    match = pattern.fullmatch
+    return [Path(f) for f in files if match(f)]
+
+
+def git_files(git_root: Path, *pathspec: str) -> List[str]:
     files_out = subprocess.run(
-        ["git", "-C", str(git_root), "ls-files"],
+        ["git", "-C", str(git_root), "ls-files", "-z", "--", *pathspec],
         check=True,
         stdout=subprocess.PIPE,
-        text=True,
     ).stdout
-    files = files_out.splitlines()
-    return [Path(f) for f in files if pattern.fullmatch(f)]
+    # unquoted paths, matching the ones reported by git log -z
+    return [os.fsdecode(f) for f in files_out.split(b"\0") if f]
 
 
-def acquire_base_data(git_root: Path, pattern: Pattern) -> pd.DataFrame:
+def acquire_base_data(
+    git_root: Path,
+    pattern: Pattern,
+    follow_renames: bool = True,
+    jobs: Optional[int] = None,
+) -> pa.Table:
     files = relevant_files_in_git_root(git_root, pattern)
     print(f"Analyzing {len(files)} files")
 
-    per_file_data = []
-    for file in tqdm(files):
-        per_file_data.append(acquire_file_base_data(git_root, file))
+    revisions = file_revision_information(git_root, files, follow_renames)
+
+    metrics = measure_files(git_root, files, jobs)
+    columns: List[list] = [[] for _ in SCHEMA]
+    for file, file_metrics in zip(files, metrics):
+        file_columns = acquire_file_base_data(file, revisions[file], file_metrics)
+        for column, values in zip(columns, file_columns):
+            column.extend(values)
+
+    return pa.Table.from_arrays(
+        [
+            (
+                pa.array(values, type=field.type.value_type).dictionary_encode()
+                if pa.types.is_dictionary(field.type)
+                else pa.array(values, type=field.type)
+            )
+            for field, values in zip(SCHEMA, columns)
+        ],
+        schema=SCHEMA,
+    )
+
+
+def measure_files(
+    git_root: Path, files: List[Path], jobs: Optional[int] = None
+) -> List[Metrics]:
+    """Compute the metrics of all files in parallel.
+
+    Files with identical content and name are only measured once. Paths that
+    are no regular files in the working tree, like submodules, dangling
+    symlinks or deleted files, have nothing to measure.
+    """
+    keys = list(zip(content_ids(git_root, files), (f.name for f in files)))
+    representatives: Dict[Tuple[Optional[str], str], Path] = {}
+    for key, file in zip(keys, files):
+        if key[0] is not None:
+            representatives.setdefault(key, file)
+
+    # files unknown to pygments are measured with batched cloc runs
+    lexed = {}
+    unlexed = {}
+    for key, file in representatives.items():
+        if lexer_for_file_name(file.name) is None:
+            unlexed[key] = file
+        else:
+            lexed[key] = file
+    unique_metrics = dict(zip(unlexed, cloc_metrics(git_root, list(unlexed.values()))))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        metrics = executor.map(
+            functools.partial(file_metrics, git_root), lexed.values()
+        )
+        unique_metrics.update(
+            (key, metric) for metric, key in zip(tqdm(metrics, total=len(lexed)), lexed)
+        )
+
+    return [unique_metrics.get(key, (0, 0, 0)) for key in keys]
+
 
-    return pd.concat(per_file_data)
+def content_ids(git_root: Path, files: List[Path]) -> List[Optional[str]]:
+    """Compute the git object IDs of the working tree versions of files.
+
+    Paths that are no regular files get None, git refuses to hash them.
+    """
+    regular = [(git_root / f).is_file() for f in files]
+    ids = iter(
+        subprocess.run(
+            ["git", "-C", str(git_root), "hash-object", "--stdin-paths"],
+            input=b"".join(
+                stdin_path(os.fsencode(f)) + b"\n" for f, r in zip(files, regular) if r
+            ),
+            check=True,
+            stdout=subprocess.PIPE,
+        )
+        .stdout.decode()
+        .splitlines()
+    )
+    return [next(ids) if r else None for r in regular]
 
 
-def acquire_file_base_data(git_root: Path, file: Path) -> pd.DataFrame:
-    data = file_revision_information(git_root, file)
-    data["indentation"] = count_indentations(git_root / file)
-    lines_code, line_comment = count_lines(git_root / file)
-    data["lines_code"] = lines_code
-    data["lines_comment"] = line_comment
+def stdin_path(path: bytes) -> bytes:
+    """Quote a path for git commands reading one path per line.
 
-    return data
+    git C-unquotes lines starting with a double quote, which also allows
+    passing names containing newlines.
+    """
+    if not path.startswith(b'"') and b"\n" not in path:
+        return path
+    escaped = path.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+    return b'"' + escaped.replace(b"\n", b"\\n") + b'"'
+
+
+SCHEMA = pa.schema(
+    [
+        ("file", pa.dictionary(pa.int32(), pa.string())),
+        ("commit", pa.string()),
+        ("author_date", pa.timestamp("s", tz="UTC")),
+        ("commit_date", pa.timestamp("s", tz="UTC")),
+        ("indentation", pa.int64()),
+        ("lines_code", pa.int64()),
+        ("lines_comment", pa.int64()),
+    ]
+)
+
+
+def acquire_file_base_data(
+    file: Path, revisions: List[Revision], metrics: Metrics
+) -> Tuple[list, ...]:
+    """Build the rows of a file as one list per field of SCHEMA."""
+    count = len(revisions)
+    indentation, lines_code, line_comment = metrics
+    return (
+        [str(file)] * count,
+        [r[0] for r in revisions],
+        [r[1] for r in revisions],
+        [r[2] for r in revisions],
+        [indentation] * count,
+        [lines_code] * count,
+        [line_comment] * count,
+    )
 
 
-def file_revision_information(git_root: Path, file: Path) -> pd.DataFrame:
-    log_out = subprocess.run(
+def file_metrics(git_root: Path, file: Path) -> Metrics:
+    """Measure a file written in a language known to pygments."""
+    lexer = lexer_for_file_name(file.name)
+    assert lexer is not None
+
+    code, line_comment = split_code_and_comments(
+        (git_root / file).read_bytes().decode(errors="replace"), lexer
+    )
+    return indentation_of(code), len(code), line_comment
+
+
+# prefix of the commit headers in the log, file entries start with a status
+COMMIT_MARKER = "COMMIT "
+
+
+def file_revision_information(
+    git_root: Path, files: List[Path], follow_renames: bool = True
+) -> Dict[Path, List[Revision]]:
+    """Collect the commits touching each of the given files.
+
+    The whole history is scanned with a single ``git log`` call instead of one
+    call per file. With ``follow_renames``, commits made before a file was
+    renamed are attributed to its current name, similar to ``git log --follow``.
+    """
+    revisions: Dict[str, List[Revision]] = {str(f): [] for f in files}
+    # maps names from older history to the current name of a file, None for
+    # names that were replaced by a rename and belong to a different file
+    renames: Dict[str, Optional[str]] = {}
+    revision: Revision
+    # parse the log while git is still producing it
+    with subprocess.Popen(
         [
             "git",
             "-C",
             str(git_root),
             "log",
-            "--format=format:%H %aI %cI",
-            "--follow",
-            "--",
-            file,
+            "-z",
+            f"--format=format:{COMMIT_MARKER}%H %at %ct",
+            "--name-status",
+            "-M" if follow_renames else "--no-renames",
+            "--relative",
         ],
-        check=True,
         stdout=subprocess.PIPE,
-        text=True,
-    ).stdout.splitlines()
-
-    commit = []
-    author_date = []
-    commit_date = []
-    for line in log_out:
-        parts = line.split(" ")
-        commit.append(parts[0])
-        author_date.append(parts[1])
-        commit_date.append(parts[2])
-
-    return pd.DataFrame(
-        {
-            "file": str(file),
-            "commit": commit,
-            "author_date": pd.to_datetime(author_date, utc=True),
-            "commit_date": pd.to_datetime(commit_date, utc=True),
-        }
+    ) as log:
+        assert log.stdout is not None
+        fields = nul_separated(log.stdout)
+        for field in fields:
+            if field.startswith(COMMIT_MARKER):
+                # the first status of a commit follows its header after a newline
+                header, _, field = field.partition("\n")
+                _, commit, author_date, commit_date = header.split(" ", 3)
+                revision = (commit, int(author_date), int(commit_date))
+            if not field:
+                # commits are separated by empty fields
+                continue
+
+            status = field
+            # renames and copies report the old and the new path
+            paths = [next(fields) for _ in range(2 if status[0] in "RC" else 1)]
+            name = renames.get(paths[-1], paths[-1])
+            if name in revisions:
+                revisions[name].append(revision)
+            if status.startswith("R"):
+                renames[paths[-1]] = None
+                renames[paths[0]] = name
+    if log.returncode != 0:
+        raise subprocess.CalledProcessError(log.returncode, log.args)
+
+    return {f: revisions[str(f)] for f in files}
+
+
+def nul_separated(stream: IO[bytes], chunk_size: int = 1 << 16) -> Iterator[str]:
+    """Iterate the NUL separated fields of a stream as they arrive."""
+    rest = b""
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        *fields, rest = (rest + chunk).split(b"\0")
+        for field in fields:
+            yield os.fsdecode(field)
+    if rest:
+        yield os.fsdecode(rest)
+
+
+@functools.lru_cache(maxsize=None)
+def special_file_names() -> Pattern:
+    """Match the lexer file name patterns that are no plain extension.
+
+    Examples are Makefile, CMakeLists.txt or *.html.j2.
+    """
+    return re.compile(
+        "|".join(
+            fnmatch.translate(pattern)
+            for _, _, patterns, _ in get_all_lexers()
+            for pattern in patterns
+            if not re.fullmatch(r"\*\.[^.*?\[\]]+", pattern)
+        )
+    )
+
+
+def lexer_for_file_name(name: str) -> Optional[Lexer]:
+    """Find a lexer for files of the given name.
+
+    Returns None for languages pygments does not know about, these need to be
+    measured with cloc instead.
+    """
+    # the lookup is slow, share it between all names with the same extension
+    # unless a special pattern might apply
+    suffix = PurePath(name).suffix
+    special = special_file_names()
+    if suffix and not (special.match(name) or special.match(suffix)):
+        return lookup_lexer(suffix)
+    return lookup_lexer(name)
+
+
+@functools.lru_cache(maxsize=None)
+def lookup_lexer(name: str) -> Optional[Lexer]:
+    try:
+        lexer = get_lexer_for_filename(name, stripnl=False)
+    except ClassNotFound:
+        return None
+    if isinstance(lexer, TextLexer):
+        return None
+    return lexer
+
+
+# preprocessor directives are comment tokens in pygments but code for cloc
+PREPROCESSOR_TOKENS = (Comment.Preproc, Comment.PreprocFile)
+
+
+@functools.lru_cache(maxsize=None)
+def is_comment_token(token_type: _TokenType) -> bool:
+    if token_type in String.Doc:
+        return True
+    return token_type in Comment and not any(
+        token_type in t for t in PREPROCESSOR_TOKENS
+    )
+
+
+def split_code_and_comments(content: str, lexer: Lexer) -> Tuple[List[str], int]:
+    """Find the lines containing code and count the pure comment lines.
+
+    Follows the cloc semantics: lines with code and a trailing comment are
+    code, docstrings are comments and blank lines are neither.
+    """
+    code: List[str] = []
+    line_comment = 0
+
+    line: List[str] = []
+    has_code = False
+    has_comment = False
+    for token_type, value in lexer.get_tokens(content):
+        is_comment = is_comment_token(token_type)
+        for i, segment in enumerate(value.split("\n")):
+            if i > 0:
+                if has_code:
+                    code.append("".join(line))
+                elif has_comment:
+                    line_comment += 1
+                line = []
+                has_code = False
+                has_comment = False
+            line.append(segment)
+            if segment.strip():
+                has_comment = has_comment or is_comment
+                has_code = has_code or not is_comment
+    if has_code:
+        code.append("".join(line))
+    elif has_comment:
+        line_comment += 1
+
+    return code, line_comment
+
+
+INDENTATION_CHARS = np.zeros(256, dtype=bool)
+INDENTATION_CHARS[list(b" \t\r\v\f")] = True
+
+
+def indentation_of(lines: List[str]) -> int:
+    # TODO hard-coded assumption
+    content = "\n".join(lines).replace("\t", 4 * " ") + "\n"
+    buffer = np.frombuffer(content.encode(), dtype=np.uint8)
+    line_starts = np.concatenate(([0], np.flatnonzero(buffer == ord("\n"))[:-1] + 1))
+    # every line ends with a newline, so each line has an indentation end
+    indentation_ends = np.flatnonzero(~INDENTATION_CHARS[buffer])
+    return int(
+        (
+            indentation_ends[np.searchsorted(indentation_ends, line_starts)]
+            - line_starts
+        ).sum()
     )
 
 
-def count_lines(file: Path) -> Tuple[int, int]:
+def cloc_metrics(git_root: Path, files: List[Path]) -> List[Metrics]:
+    """Measure files with cloc, processing all of them in as few runs as possible."""
+    if not files:
+        return []
+
+    paths = [str(git_root.resolve() / f) for f in files]
+    with TemporaryDirectory() as work_dir:
+        lines = count_lines(cloc_inputs(paths, Path(work_dir) / "files"))
+        indentations = count_indentations(paths, Path(work_dir))
+
+    return [(indentations[p], *lines.get(p, (0, 0))) for p in paths]
+
+
+def cloc_inputs(paths: List[str], list_file: Path) -> List[str]:
+    """Create the cloc arguments for processing the paths.
+
+    The paths are passed through a list file where possible. It has one path
+    per line, so names containing newlines are passed as arguments instead.
+    """
+    list_file.write_bytes(
+        b"".join(os.fsencode(p) + b"\n" for p in paths if "\n" not in p)
+    )
+    return [f"--list-file={list_file}", *(p for p in paths if "\n" in p)]
+
+
+def count_lines(inputs: List[str]) -> Dict[str, Tuple[int, int]]:
     cloc_out = subprocess.run(
-        ["cloc", "--json", file], check=True, stdout=subprocess.PIPE
+        ["cloc", "--json", "--by-file", "--skip-uniqueness", *inputs],
+        check=True,
+        stdout=subprocess.PIPE,
     ).stdout
     if cloc_out.strip():
         cloc_data = json.loads(cloc_out)
-        return cloc_data["SUM"]["code"], cloc_data["SUM"]["comment"]
+        return {
+            path: (counts["code"], counts["comment"])
+            for path, counts in cloc_data.items()
+            if path not in ("header", "SUM")
+        }
     else:
-        return 0, 0
+        return {}
 
 
 STRIPPED_EXT = "stripped"
 
 
-def count_indentations(file: Path) -> int:
-    with TemporaryDirectory() as work_dir:
+def count_indentations(paths: List[str], work_dir: Path) -> Dict[str, int]:
+    # cloc names the stripped files after the original base name. Every run
+    # therefore only gets files with distinct names.
+    runs: List[List[str]] = []
+    name_count: Counter = Counter()
+    for path in paths:
+        name = Path(path).name
+        if name_count[name] == len(runs):
+            runs.append([])
+        runs[name_count[name]].append(path)
+        name_count[name] += 1
+
+    indentations = {}
+    for i, run_paths in enumerate(runs):
+        run_dir = work_dir / f"strip-{i}"
+        run_dir.mkdir()
         subprocess.run(
-            ["cloc", f"--strip-comments={STRIPPED_EXT}", file],
+            [
+                "cloc",
+                "--skip-uniqueness",
+                f"--strip-comments={STRIPPED_EXT}",
+                *cloc_inputs(run_paths, work_dir / f"strip-{i}-files"),
+            ],
             check=True,
-            cwd=work_dir,
+            cwd=run_dir,
             stdout=subprocess.PIPE,
         )
 
-        try:
-            stripped_content = (
-                Path(work_dir) / f"{file.name}.{STRIPPED_EXT}"
-            ).read_text()
-            # TODO hard-coded assumption
-            stripped_content = stripped_content.replace("\t", 4 * " ")
-            lines = stripped_content.splitlines()
-            counts = [
-                sum(1 for _ in itertools.takewhile(str.isspace, line)) for line in lines
-            ]
-            return sum(counts)
-        except FileNotFoundError:
-            # cloc skips empty files
-            return 0
+        for path in run_paths:
+            try:
+                stripped_content = (
+                    run_dir / f"{Path(path).name}.{STRIPPED_EXT}"
+                ).read_text()
+                indentations[path] = indentation_of(stripped_content.splitlines())
+            except FileNotFoundError:
+                # cloc skips empty files
+                indentations[path] = 0
+
+    return indentations
@@ -1,4 +1,7 @@
-from typing import Dict
+import functools
+import math
+import re
+from typing import Callable, Dict, List, Optional, Tuple
 
 import dash
 import dash_core_components as dcc
@@ -9,86 +12,194 @@ import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-
-
-def hotspots_figure(data: pd.DataFrame, cutoff: int = 10) -> go.Figure:
-    data = data.groupby("file", as_index=False).agg(
-        {"commit": "count", "lines_code": "first", "indentation": "first"}
+import scipy.sparse as sp
+
+
+def aggregate_hotspots(data: pd.DataFrame) -> pd.DataFrame:
+    """Compute the per-file values displayed in the hotspots figure."""
+    # named aggregations drop the group column with as_index=False on pandas 1.0
+    hotspots = (
+        data.groupby("file", sort=False, observed=True)
+        .agg(
+            revisions=("commit", "count"),
+            lines_code=("lines_code", "first"),
+            indentation=("indentation", "first"),
+        )
+        .reset_index()
     )
-    data = data.rename(columns={"commit": "revisions"})
+    if isinstance(data["file"].dtype, pd.CategoricalDtype):
+        # without sorting, categories come in the order of appearance, keep
+        # the ones of the data so that their codes match
+        hotspots["file"] = hotspots["file"].cat.set_categories(
+            data["file"].cat.categories
+        )
+    return hotspots
+
 
-    data["urgency"] = (data["indentation"] / data["indentation"].max()) * (
-        data["revisions"] / data["revisions"].max()
-    ).pow(1.0 / 2)
+# number of files above which the hotspots are binned instead of scattered
+HOTSPOTS_SCATTER_LIMIT = 5000
 
-    data = data[data["revisions"] >= cutoff]
 
-    fig = px.scatter(
-        data,
-        x="revisions",
-        y="lines_code",
-        size="indentation",
-        hover_name="file",
-        color="urgency",
-        color_continuous_scale="dense",
+def hotspots_figure(hotspots: pd.DataFrame, cutoff: int = 10) -> go.Figure:
+    # single precision is plenty for a color scale
+    indentation = hotspots["indentation"].to_numpy(np.float32)
+    revisions = hotspots["revisions"].to_numpy(np.float32)
+    # initial keeps the maxima defined when no file matches the filter
+    urgency = (indentation / indentation.max(initial=0)) * np.sqrt(
+        revisions / revisions.max(initial=0)
     )
-    fig.update_traces(marker={"line": {"width": 1, "color": "gray"}})
+
+    keep = revisions >= cutoff
+    data = hotspots[keep].assign(urgency=urgency[keep])
+
+    if len(data) > HOTSPOTS_SCATTER_LIMIT:
+        # individual markers become unusable for that many files, show the
+        # density of the indentation instead
+        fig = px.density_heatmap(
+            data,
+            x="revisions",
+            y="lines_code",
+            z="indentation",
+            histfunc="sum",
+            nbinsx=100,
+            nbinsy=100,
+            color_continuous_scale="dense",
+        )
+    else:
+        fig = px.scatter(
+            data,
+            x="revisions",
+            y="lines_code",
+            size="indentation",
+            hover_name="file",
+            color="urgency",
+            color_continuous_scale="dense",
+            render_mode="webgl",
+        )
+        fig.update_traces(marker={"line": {"width": 1, "color": "gray"}})
     fig.update_layout(height=1000)
 
     return fig
 
 
-def compute_correlations(data: pd.DataFrame, cutoff: int = 10) -> pd.DataFrame:
-    correlation = (
-        data.merge(data, on="commit", how="inner")
-        .groupby(["file_x", "file_y"], as_index=False)["commit"]
-        .count()
-        .sort_values(["file_x", "file_y"])
-    )
-    # kill diagonal
-    correlation.loc[correlation["file_x"] == correlation["file_y"], "commit"] = np.nan
-    # cutoff
-    correlation = correlation[correlation["commit"] >= cutoff]
-
-    return correlation[["file_x", "file_y", "commit"]].rename(
-        columns={"commit": "commits"}
+def incidence_matrix(
+    commit_codes: np.ndarray, file_codes: np.ndarray, n_commits: int, n_files: int
+) -> sp.csc_matrix:
+    """Build the commit x file incidence matrix from integer codes."""
+    return sp.csc_matrix(
+        (np.ones(len(commit_codes), dtype=np.int32), (commit_codes, file_codes)),
+        shape=(n_commits, n_files),
     )
 
 
-def correlation_figure(data: pd.DataFrame, cutoff: int = 10) -> go.Figure:
-    correlation = compute_correlations(data, cutoff)
+def correlations_from_incidence(
+    incidence: sp.spmatrix, files: np.ndarray, cutoff: int = 10
+) -> pd.DataFrame:
+    """Compute the correlations of the files forming the incidence columns.
+
+    Each pair is only contained once, ordered so that ``file_x < file_y``.
+    """
+    # the product of the transposed incidence matrix with itself counts the
+    # commits shared by each pair of files
+    cooccurrence = (incidence.T @ incidence).tocoo()
+
+    # the product is symmetric, keep the upper triangle without the diagonal
+    keep = (cooccurrence.row < cooccurrence.col) & (cooccurrence.data >= cutoff)
+    files = np.asarray(files)
+    file_x = files[cooccurrence.row[keep]]
+    file_y = files[cooccurrence.col[keep]]
+    # the column order of the files is arbitrary
+    swap = file_x > file_y
+    return pd.DataFrame(
+        {
+            "file_x": np.where(swap, file_y, file_x),
+            "file_y": np.where(swap, file_x, file_y),
+            "commits": cooccurrence.data[keep],
+        }
+    )
 
-    sort_order = natsorted(correlation["file_x"].unique())
 
-    fig = px.density_heatmap(
-        correlation,
-        x="file_x",
-        y="file_y",
-        z="commits",
-        color_continuous_scale="dense",
-        category_orders={"file_x": sort_order, "file_y": sort_order},
+def correlation_figure(
+    correlation: pd.DataFrame, file_order: Optional[Dict[str, int]] = None
+) -> go.Figure:
+    """Plot the correlations as a heatmap.
+
+    ``file_order`` maps each file to its position in the natural sort order.
+    Computing it once for all files avoids the natsort overhead per figure.
+    """
+    files = pd.unique(np.concatenate([correlation["file_x"], correlation["file_y"]]))
+    if file_order is None:
+        sort_order = natsorted(files)
+    else:
+        sort_order = sorted(files, key=file_order.__getitem__)
+    # the counts are already aggregated, send them as a matrix instead of
+    # letting the browser bin the individual pairs
+    matrix = (
+        correlation.pivot(index="file_y", columns="file_x", values="commits")
+        .reindex(index=sort_order, columns=sort_order)
+        .fillna(0)
+        .astype(int)
+        .to_numpy()
+    )
+    # only one triangle is contained in the correlations
+    matrix = matrix + matrix.T
+
+    fig = go.Figure(
+        go.Heatmap(
+            z=matrix,
+            x=sort_order,
+            y=sort_order,
+            colorscale="dense",
+            colorbar={"title": "commits"},
+            hovertemplate="file_x=%{x}<br>file_y=%{y}<br>commits=%{z}<extra></extra>",
+        )
     )
     fig.update_layout(xaxis_title="file", yaxis_title="file", height=1000)
-    fig.update_yaxes(automargin=True)
-    fig.update_xaxes(automargin=True)
+    fig.update_yaxes(automargin=True, type="category")
+    fig.update_xaxes(automargin=True, type="category")
 
     return fig
 
 
-def correlation_table_data(data: pd.DataFrame, cutoff: int = 10) -> pd.DataFrame:
-    data = compute_correlations(data, cutoff)
-    data["duplicates"] = data[["file_x", "file_y"]].apply(
-        lambda x: "-".join(sorted(x)), axis=1
-    )
-    data = data.drop_duplicates(subset=["duplicates"])
-    del data["duplicates"]
-    return data.sort_values(["commits", "file_x", "file_y"], ascending=False)
+def correlation_table_data(correlation: pd.DataFrame) -> pd.DataFrame:
+    return correlation.sort_values(["commits", "file_x", "file_y"], ascending=False)
+
+
+# regexes that only select a file extension, like the default \.py$
+EXTENSION_REGEX = re.compile(r"\\\.(\w+)\$")
+
+
+@functools.lru_cache(maxsize=32)
+def file_predicate(file_regex: str) -> Callable[[str], bool]:
+    """Create a function deciding whether a file name matches the regex."""
+    extension = EXTENSION_REGEX.fullmatch(file_regex)
+    if extension:
+        suffix = "." + extension.group(1)
+        return lambda f: f.endswith(suffix)
+
+    search = re.compile(file_regex).search
+    return lambda f: search(f) is not None
 
 
-def filter_data(data: pd.DataFrame, file_regex: str) -> pd.DataFrame:
-    return data[data["file"].str.contains(file_regex)]
+def match_files(files: pd.Index, file_regex: str) -> np.ndarray:
+    """Compute a mask of the file names matching the regex."""
+    predicate = file_predicate(file_regex)
+    return np.fromiter((predicate(f) for f in files), dtype=bool, count=len(files))
 
 
+def filter_data(data: pd.DataFrame, matches: np.ndarray) -> pd.DataFrame:
+    """Select the rows of matching files.
+
+    The file column has to be categorical and ``matches`` is a mask over its
+    categories as computed by match_files. The regex therefore only needs to be
+    evaluated once per file instead of once per row.
+    """
+    return data[matches[data["file"].cat.codes.to_numpy()]]
+
+
+# columns of the analysis results used by the dashboard
+data_columns = ["file", "commit", "lines_code", "indentation"]
+
 file_regex_id = "file_regex"
 hotspots_figure_id = "file_hotspots"
 revision_cutoff_id = "correlation_cutoff"
@@ -99,6 +210,9 @@ tab_file_change_coupling_id = "file-change-coupling"
 tab_id = "tabs"
 tab_content_id = "tab-content"
 
+# lowest revision cutoff selectable in the filters
+REVISION_CUTOFF_MIN = 10
+
 
 def common_filters():
     return html.Div(
@@ -116,7 +230,7 @@ def common_filters():
                     html.Label(children="Revision cutoff", htmlFor=revision_cutoff_id),
                     dcc.Slider(
                         id=revision_cutoff_id,
-                        min=10,
+                        min=REVISION_CUTOFF_MIN,
                         max=50,
                         value=20,
                         step=1,
@@ -133,19 +247,86 @@ def create_app(data: pd.DataFrame) -> dash.Dash:
         __name__, external_stylesheets=["https://codepen.io/chriddyp/pen/bWLwgP.css"]
     )
 
-    corr_table_data = correlation_table_data(data, 10)
+    data = data.assign(
+        # repeated strings, also speeds up grouping and factorizing
+        file=data["file"].astype("category"),
+        commit=data["commit"].astype("category"),
+        # the metrics fit into small integers
+        lines_code=pd.to_numeric(data["lines_code"], downcast="integer"),
+        indentation=pd.to_numeric(data["indentation"], downcast="integer"),
+    )
+    hotspots = aggregate_hotspots(data)
+    file_order = {f: i for i, f in enumerate(natsorted(data["file"].cat.categories))}
+
+    # The regex changes far less often than the cutoff. Filtering and
+    # computing the correlations are therefore cached per regex and only the
+    # cheap cutoff is applied on every update.
+
+    # a mask over the file categories, which the hotspots share with the data
+    @functools.lru_cache(maxsize=8)
+    def matching_files(file_regex: str) -> np.ndarray:
+        return match_files(data["file"].cat.categories, file_regex)
+
+    @functools.lru_cache(maxsize=8)
+    def filtered_hotspots(file_regex: str) -> pd.DataFrame:
+        return filter_data(hotspots, matching_files(file_regex))
+
+    # built once for all files, filtering only selects its columns
+    incidence = incidence_matrix(
+        data["commit"].cat.codes.to_numpy(),
+        data["file"].cat.codes.to_numpy(),
+        len(data["commit"].cat.categories),
+        len(data["file"].cat.categories),
+    )
 
+    @functools.lru_cache(maxsize=8)
+    def all_correlations(file_regex: str) -> pd.DataFrame:
+        matches = matching_files(file_regex)
+        correlation = correlations_from_incidence(
+            incidence[:, matches],
+            np.asarray(data["file"].cat.categories)[matches],
+            cutoff=REVISION_CUTOFF_MIN,
+        )
+        # sorted by the counts, every cutoff selects a suffix
+        return correlation.sort_values("commits", ignore_index=True)
+
+    def correlations(file_regex: str, cutoff: int) -> pd.DataFrame:
+        correlation = all_correlations(file_regex)
+        start = np.searchsorted(correlation["commits"].to_numpy(), cutoff)
+        return correlation.iloc[start:]
+
+    # Dash accepts the serialized figures, caching them skips the pandas and
+    # plotly work when returning to previous filter values
+    @functools.lru_cache(maxsize=64)
+    def hotspots_figure_json(file_regex: str, cutoff: int) -> Dict:
+        return hotspots_figure(filtered_hotspots(file_regex), cutoff).to_plotly_json()
+
+    @functools.lru_cache(maxsize=64)
+    def correlation_figure_json(file_regex: str, cutoff: int) -> Dict:
+        return correlation_figure(
+            correlations(file_regex, cutoff), file_order
+        ).to_plotly_json()
+
+    @functools.lru_cache(maxsize=64)
+    def correlation_table(file_regex: str, cutoff: int) -> pd.DataFrame:
+        return correlation_table_data(correlations(file_regex, cutoff))
+
+    # The tabs are rendered without content. The callbacks fire as soon as
+    # the components are added and fill them for the current filters, which
+    # keeps the startup free of the expensive computations.
     tab_render_mapping = {
-        tab_file_hotspots_id: lambda data: dcc.Graph(
-            id=hotspots_figure_id, figure=hotspots_figure(data)
-        ),
-        tab_file_change_coupling_id: lambda data: html.Div(
+        tab_file_hotspots_id: lambda: dcc.Graph(id=hotspots_figure_id),
+        tab_file_change_coupling_id: lambda: html.Div(
             children=[
-                dcc.Graph(id=correlation_figure_id, figure=correlation_figure(data)),
+                dcc.Graph(id=correlation_figure_id),
                 dash_table.DataTable(
                     id=correlation_table_id,
-                    data=corr_table_data.to_dict("records"),
-                    columns=[{"id": c, "name": c} for c in corr_table_data.columns],
+                    columns=[
+                        {"id": c, "name": c} for c in ["file_x", "file_y", "commits"]
+                    ],
+                    # only the displayed page is sent to the browser
+                    page_action="custom",
+                    page_current=0,
                     page_size=20,
                 ),
             ],
@@ -170,7 +351,7 @@ def create_app(data: pd.DataFrame) -> dash.Dash:
         ]
     )
     app.validation_layout = html.Div(
-        app.layout.children + [f(data) for f in tab_render_mapping.values()]
+        app.layout.children + [f() for f in tab_render_mapping.values()]
     )
 
     @app.callback(
@@ -178,7 +359,7 @@ def create_app(data: pd.DataFrame) -> dash.Dash:
         [dash.dependencies.Input(tab_id, "value")],
     )
     def render_tabs(tab):
-        return tab_render_mapping[tab](data)
+        return tab_render_mapping[tab]()
 
     @app.callback(
         dash.dependencies.Output(hotspots_figure_id, "figure"),
@@ -187,8 +368,8 @@ def create_app(data: pd.DataFrame) -> dash.Dash:
             dash.dependencies.Input(revision_cutoff_id, "value"),
         ],
     )
-    def update_hotspot_figure(file_regex: str, cutoff: int) -> go.Figure:
-        return hotspots_figure(filter_data(data, file_regex), cutoff)
+    def update_hotspot_figure(file_regex: str, cutoff: int) -> Dict:
+        return hotspots_figure_json(file_regex, cutoff)
 
     @app.callback(
         dash.dependencies.Output(correlation_figure_id, "figure"),
@@ -197,19 +378,39 @@ def create_app(data: pd.DataFrame) -> dash.Dash:
             dash.dependencies.Input(file_regex_id, "value"),
         ],
     )
-    def update_correlation_figure(cutoff: int, file_regex: str) -> go.Figure:
-        return correlation_figure(filter_data(data, file_regex), cutoff)
+    def update_correlation_figure(cutoff: int, file_regex: str) -> Dict:
+        return correlation_figure_json(file_regex, cutoff)
 
     @app.callback(
-        dash.dependencies.Output(correlation_table_id, "data"),
+        dash.dependencies.Output(correlation_table_id, "page_current"),
         [
             dash.dependencies.Input(revision_cutoff_id, "value"),
             dash.dependencies.Input(file_regex_id, "value"),
         ],
     )
-    def update_correlation_table(cutoff: int, file_regex: str) -> Dict:
-        return correlation_table_data(filter_data(data, file_regex), cutoff).to_dict(
-            "records"
-        )
+    def reset_correlation_table_page(cutoff: int, file_regex: str) -> int:
+        # the previous page might not exist for the new filters
+        return 0
+
+    @app.callback(
+        [
+            dash.dependencies.Output(correlation_table_id, "data"),
+            dash.dependencies.Output(correlation_table_id, "page_count"),
+        ],
+        [
+            dash.dependencies.Input(revision_cutoff_id, "value"),
+            dash.dependencies.Input(file_regex_id, "value"),
+            dash.dependencies.Input(correlation_table_id, "page_current"),
+            dash.dependencies.Input(correlation_table_id, "page_size"),
+        ],
+    )
+    def update_correlation_table(
+        cutoff: int, file_regex: str, page_current: int, page_size: int
+    ) -> Tuple[List[Dict], int]:
+        table = correlation_table(file_regex, cutoff)
+        page_count = max(1, math.ceil(len(table) / page_size))
+        start = min(page_current, page_count - 1) * page_size
+        end = start + page_size
+        return table.iloc[start:end].to_dict("records"), page_count
 
     return app